@@ -1,10 +1,13 @@
 # =============================================================
 #  Leitor Fiscal — CT-e & NF-e   (Streamlit ≥ 1.33)
 # =============================================================
-import io, os, zipfile, tempfile, re
-from datetime import datetime
+import io, zipfile
+from functools import partial
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import streamlit as st
+import xlsxwriter
 from   lxml import etree
 # -------------------------------------------------------------
 st.set_page_config(page_title="Leitor Fiscal", layout="wide")
@@ -12,130 +15,264 @@ st.set_page_config(page_title="Leitor Fiscal", layout="wide")
 # -------------------- XML helpers ----------------------------
 NS_CTE = {"c": "http://www.portalfiscal.inf.br/cte"}
 NS_NFE = {"n": "http://www.portalfiscal.inf.br/nfe"}
-PARSER  = etree.XMLParser(ns_clean=True, recover=True)
+TAG_CTE = "{%s}infCte" % NS_CTE["c"]
+TAG_NFE = "{%s}infNFe" % NS_NFE["n"]
+# opções do iterparse (streaming: uma única passada pelo documento);
+# sem tabela de IDs, entidades/DTD ou rede — nada disso é usado aqui
+PARSE_OPTS = dict(events=("end",), recover=True, huge_tree=False,
+                  collect_ids=False, resolve_entities=False, no_network=True,
+                  remove_blank_text=True, remove_comments=True, remove_pis=True)
+
+# XPaths pré-compiladas (compiladas 1x, reaproveitadas em todos os XMLs);
+# smart_strings=False → str puro, sem referência de volta à árvore
+_CTE_DHEMI  = etree.XPath("c:ide/c:dhEmi/text()", namespaces=NS_CTE, smart_strings=False)
+_CTE_NCT    = etree.XPath("c:ide/c:nCT/text()", namespaces=NS_CTE, smart_strings=False)
+_CTE_VTPREST= etree.XPath(".//c:vTPrest/text()", namespaces=NS_CTE, smart_strings=False)
+_CTE_INFQ   = etree.XPath(".//c:infQ", namespaces=NS_CTE)
+_INFQ_CUNID = etree.XPath("c:cUnid/text()", namespaces=NS_CTE, smart_strings=False)
+_INFQ_TPMED = etree.XPath("c:tpMed/text()", namespaces=NS_CTE, smart_strings=False)
+_INFQ_QTD   = etree.XPath("c:qCarga/text()", namespaces=NS_CTE, smart_strings=False)
+_CTE_EMIT   = etree.XPath(".//c:emit/c:xNome/text()", namespaces=NS_CTE, smart_strings=False)
+_CTE_UF_O   = etree.XPath(".//c:enderEmit/c:UF/text()", namespaces=NS_CTE, smart_strings=False)
+_CTE_UF_D   = etree.XPath(".//c:dest/c:enderDest/c:UF/text()", namespaces=NS_CTE, smart_strings=False)
+_CTE_CIDADE = etree.XPath(".//c:dest/c:enderDest/c:xMun/text()", namespaces=NS_CTE, smart_strings=False)
+_CTE_CHAVE  = etree.XPath(".//c:infNFe/c:chave/text()", namespaces=NS_CTE, smart_strings=False)
+
+_NFE_DHEMI  = etree.XPath("n:ide/n:dhEmi/text()", namespaces=NS_NFE, smart_strings=False)
+_NFE_DEMI   = etree.XPath("n:ide/n:dEmi/text()", namespaces=NS_NFE, smart_strings=False)
+_NFE_NNF    = etree.XPath("n:ide/n:nNF/text()", namespaces=NS_NFE, smart_strings=False)
+_NFE_EMIT   = etree.XPath("n:emit/n:xNome/text()", namespaces=NS_NFE, smart_strings=False)
+_NFE_DEST   = etree.XPath("n:dest/n:xNome/text()", namespaces=NS_NFE, smart_strings=False)
+_NFE_VNF    = etree.XPath(".//n:ICMSTot/n:vNF/text()", namespaces=NS_NFE, smart_strings=False)
+_NFE_VICMS  = etree.XPath(".//n:ICMSTot/n:vICMS/text()", namespaces=NS_NFE, smart_strings=False)
+_NFE_TRANSP = etree.XPath("n:transp", namespaces=NS_NFE)
+_NFE_MODFRT = etree.XPath("n:transp/n:modFrete/text()", namespaces=NS_NFE, smart_strings=False)
+_NFE_TRP_NM = etree.XPath("n:transp/n:transporta/n:xNome/text()", namespaces=NS_NFE, smart_strings=False)
+_NFE_TRP_CN = etree.XPath("n:transp/n:transporta/n:CNPJ/text()", namespaces=NS_NFE, smart_strings=False)
+
+def _first(xp, node, default: str = "") -> str:
+    """Primeiro resultado de uma XPath compilada (text()) ou `default`."""
+    r = xp(node)
+    return r[0] if r else default
+
+# tabela de tradução BR: 1 passada em C em vez de cadeias de str.replace
+_BR_TABLE = str.maketrans({",": ".", ".": ","})     # 1,234.56 → 1.234,56
 
 def xml_float(t: str | None) -> float:
     return float(t.replace(",", ".")) if t else 0.0
 
-def br_money(v: float | str) -> str:
-    if isinstance(v, str): v = float(v.replace(",", "."))
-    return f"{v:,.2f}".replace(",", "_").replace(".", ",").replace("_", ".")
-
-def br_weight(kg: float) -> str:
-    return f"{kg:,.2f}".replace(",", "_").replace(".", ",").replace("_", ".")
+def _br_date(iso: str) -> str:
+    """aaaa-mm-dd[Thh:mm:ss±tz] → dd/mm/aaaa (dhEmi e o legado dEmi)."""
+    return f"{iso[8:10]}/{iso[5:7]}/{iso[0:4]}" if iso else ""
 
-def str_to_float_br(s: str) -> float:
-    return float(s.replace(".", "").replace(",", ".")) if s else 0.0
+_FRETE = {"0": "CIF (Emitente)","1": "FOB (Destinat.)",
+          "2": "Terceiros","3": "Sem frete",
+          "4": "Sem frete","9": "Sem frete",}
 
 def frete_tipo(code: str) -> str:
-    return {"0": "CIF (Emitente)","1": "FOB (Destinat.)",
-            "2": "Terceiros","3": "Sem frete",
-            "4": "Sem frete","9": "Sem frete",}.get(code.strip(), code or "--")
+    return _FRETE.get(code.strip(), code) if code else "--"
+
+# formatação BR só na exibição (colunas continuam numéricas)
+BR_COLS_CTE = ("Frete (R$)", "Peso (kg)", "R$/ton")
+BR_COLS_NFE = ("Valor NF (R$)", "ICMS (R$)")
+
+def br_view(df: pd.DataFrame, cols) -> pd.DataFrame:
+    """Cópia p/ exibição: colunas `cols` viram texto BR (1.234,56), vazio se NaN."""
+    out = df.copy(deep=False)
+    for c in cols:
+        if c in out:
+            out[c] = (out[c].map("{:,.2f}".format, na_action="ignore")
+                      .astype(object).str.translate(_BR_TABLE).fillna(""))
+    return out
 
 # =============================================================
 #  XML → dict helpers
 # =============================================================
-def parse_cte(raw: bytes, fname: str) -> list[dict]:
+def _iter_tag(fp, tag: str):
+    """
+    Elementos `tag` lidos em streaming de `fp` (arquivo ou membro de ZIP).
+    Após o uso, cada um é limpo junto com os irmãos anteriores → a memória
+    fica limitada a uma subárvore por vez.
+    """
+    for _, elem in etree.iterparse(fp, tag=tag, **PARSE_OPTS):
+        yield elem
+        elem.clear(keep_tail=False)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+def cols_extend(cols: dict[str, list], block: dict[str, list]) -> None:
+    """Anexa um bloco colunar (dict de listas) às colunas acumuladas."""
+    for k, v in block.items(): cols.setdefault(k, []).extend(v)
+
+def cols_append(cols: dict[str, list], row: dict) -> None:
+    """Anexa uma linha (dict) às colunas acumuladas."""
+    for k, v in row.items(): cols.setdefault(k, []).append(v)
+
+
+_CUNID_KG = {"01": 1.0, "02": 1000.0}             # cUnid: 01 = KG, 02 = TON
+
+def _peso_kg(inf) -> float:
     """
-    Devolve lista (1¹ ou “várias linhas”, uma por NF) para montar DataFrame.
+    Peso (kg) de um <infCte>. As <infQ> são medidas da MESMA carga (PESO BRUTO,
+    PESO BASE DE CALCULO, VOLUMES...): só contam kg/ton e de um único tpMed —
+    PESO BRUTO quando houver, senão o primeiro tpMed em kg/ton informado.
     """
-    try: root = etree.fromstring(raw, PARSER)
-    except Exception: return []
-
-    inf = root.find(".//c:infCte", NS_CTE)
-    if inf is None: return []
-
-    data = datetime.fromisoformat(
-        inf.findtext("c:ide/c:dhEmi", "", NS_CTE)).strftime("%d/%m/%Y")
-
-    frete = xml_float(inf.findtext(".//c:vTPrest", "0", NS_CTE))
-    peso  = sum({xml_float(n.text) for n in root.findall(".//c:qCarga", NS_CTE)})
-
-    emit   = root.findtext(".//c:emit/c:xNome", "", NS_CTE)
-    uf_o   = root.findtext(".//c:enderEmit/c:UF", "", NS_CTE)
-    uf_d   = root.findtext(".//c:dest/c:enderDest/c:UF", "", NS_CTE)
-    cidade = root.findtext(".//c:dest/c:enderDest/c:xMun", "", NS_CTE)
-    n_cte  = inf.findtext("c:ide/c:nCT", "", NS_CTE)
-
-    chaves = [n.findtext("c:chave", "", NS_CTE)
-              for n in root.findall(".//c:infNFe", NS_CTE)] or [""]
-
-    linhas=[]
-    for chave in chaves:
-        linhas.append({
-            "Data": data,
-            "Mês-Ano": pd.to_datetime(data, format="%d/%m/%Y").strftime("%Y-%m"),
-            "Número CT-e": n_cte,
-            "Emitente": emit,
-            "UF Orig": uf_o,
-            "UF Dest": uf_d,
-            "Cidade Dest": cidade,
-            "Frete (R$)": br_money(frete),
-            "Peso (kg)": br_weight(peso),
-            "R$/ton": br_money(frete/(peso/1000)) if peso else "",
-            "Chave NF": chave,
-            "Arquivo": fname
-        })
-    return linhas
-
-
-def parse_nfe(raw: bytes, fname:str) -> dict|None:
-    try: rt = etree.fromstring(raw, PARSER)
-    except Exception: return None
-    if etree.QName(rt.tag).localname == "nfeProc":
-        rt = rt.find(".//n:NFe", NS_NFE) or rt
-
-    inf = rt.find(".//n:infNFe", NS_NFE)
-    if inf is None: return None
-
-    ide  = inf.find("n:ide", NS_NFE)
-    emit = inf.find("n:emit", NS_NFE)
-    dest = inf.find("n:dest", NS_NFE)
-    tot  = inf.find(".//n:ICMSTot", NS_NFE)
-
-    data  = datetime.fromisoformat(
-        ide.findtext("n:dhEmi", "", NS_NFE) or ide.findtext("n:dEmi", "", NS_NFE)
-    ).strftime("%d/%m/%Y")
+    pesos = []
+    for q in _CTE_INFQ(inf):
+        fator = _CUNID_KG.get(_first(_INFQ_CUNID, q).strip())
+        if fator:
+            pesos.append((_first(_INFQ_TPMED, q).strip().upper(),
+                          xml_float(_first(_INFQ_QTD, q)) * fator))
+    if not pesos: return 0.0
+    tp = next((t for t, _ in pesos if "BRUTO" in t), pesos[0][0])
+    return sum(v for t, v in pesos if t == tp)
+
+
+def _extract_cte(inf, fname: str) -> dict[str, list]:
+    """Colunas (uma linha por NF referenciada) a partir de um <infCte>."""
+    data = _br_date(_first(_CTE_DHEMI, inf))
+
+    frete = xml_float(_first(_CTE_VTPREST, inf, "0"))
+    peso  = _peso_kg(inf)
+
+    emit   = _first(_CTE_EMIT, inf)
+    uf_o   = _first(_CTE_UF_O, inf)
+    uf_d   = _first(_CTE_UF_D, inf)
+    cidade = _first(_CTE_CIDADE, inf)
+    n_cte  = _first(_CTE_NCT, inf)
+
+    chaves = _CTE_CHAVE(inf) or [""]
+    k      = len(chaves)
+    mes_ano= f"{data[6:10]}-{data[3:5]}" if data else ""   # dd/mm/aaaa → aaaa-mm
+    r_ton  = frete/(peso/1000) if peso else None
+
+    # colunar (uma lista por coluna, um item por NF referenciada)
+    return {
+        "Data": [data]*k,
+        "Mês-Ano": [mes_ano]*k,
+        "Número CT-e": [n_cte]*k,
+        "Emitente": [emit]*k,
+        "UF Orig": [uf_o]*k,
+        "UF Dest": [uf_d]*k,
+        "Cidade Dest": [cidade]*k,
+        "Frete (R$)": [frete]*k,
+        "Peso (kg)": [peso]*k,
+        "R$/ton": [r_ton]*k,
+        "Chave NF": chaves,
+        "Arquivo": [fname]*k
+    }
+
+
+def _extract_nfe(inf, fname: str) -> dict:
+    """Linha da NF-e a partir de um <infNFe> (com ou sem nfeProc)."""
+    data  = _br_date(_first(_NFE_DHEMI, inf) or _first(_NFE_DEMI, inf))
 
     chave = inf.get("Id","").lstrip("NFe")
-    transp= inf.find("n:transp", NS_NFE)
-    tnode = transp.find("n:transporta", NS_NFE) if transp is not None else None
+    transp= _first(_NFE_TRANSP, inf, None)
 
     return {
         "Data": data,
-        "Número NF": ide.findtext("n:nNF", "", NS_NFE),
+        "Número NF": _first(_NFE_NNF, inf),
         "Chave NF": chave,
-        "Emitente NF": emit.findtext("n:xNome", "", NS_NFE),
-        "Destinatário": dest.findtext("n:xNome", "", NS_NFE),
-        "Valor NF (R$)": br_money(xml_float(tot.findtext("n:vNF", "0", NS_NFE))),
-        "ICMS (R$)": br_money(xml_float(tot.findtext("n:vICMS","0",NS_NFE))),
-        "Transportadora": tnode.findtext("n:xNome", "", NS_NFE) if tnode else "",
-        "CNPJ Transp": tnode.findtext("n:CNPJ", "", NS_NFE) if tnode else "",
-        "Tipo Frete": frete_tipo(transp.findtext("n:modFrete","",NS_NFE)) if transp else "",
+        "Emitente NF": _first(_NFE_EMIT, inf),
+        "Destinatário": _first(_NFE_DEST, inf),
+        "Valor NF (R$)": xml_float(_first(_NFE_VNF, inf, "0")),
+        "ICMS (R$)": xml_float(_first(_NFE_VICMS, inf, "0")),
+        "Transportadora": _first(_NFE_TRP_NM, inf),
+        "CNPJ Transp": _first(_NFE_TRP_CN, inf),
+        "Tipo Frete": frete_tipo(_first(_NFE_MODFRT, inf)) if transp is not None else "",
         "Arquivo": fname
     }
 
+
+def parse_cte_stream(fp, fname: str) -> dict[str, list]:
+    """Colunas de todos os <infCte> de `fp` (uma linha por NF referenciada)."""
+    cols={}
+    try:
+        for inf in _iter_tag(fp, TAG_CTE): cols_extend(cols, _extract_cte(inf, fname))
+    except etree.LxmlError: pass
+    return cols
+
+
+def parse_nfe_stream(fp, fname: str) -> dict[str, list]:
+    """Colunas de todos os <infNFe> de `fp` (uma linha por NF-e)."""
+    cols={}
+    try:
+        for inf in _iter_tag(fp, TAG_NFE): cols_append(cols, _extract_nfe(inf, fname))
+    except etree.LxmlError: pass
+    return cols
+
+_STREAMS = {"cte": parse_cte_stream, "nfe": parse_nfe_stream}
+
+# memoizado: reruns do Streamlit não re-parseiam lotes já vistos
+@st.cache_data(show_spinner=False, max_entries=64)
+def parse_uploads(uploads: list[tuple[str, bytes]], kind: str) -> dict[str, list]:
+    """
+    Colunas de todos os uploads (XMLs avulsos e ZIPs de XMLs). Cada membro do
+    ZIP vai do `zf.open` direto para o iterparse, sem materializar os bytes
+    descompactados; XMLs avulsos e membros de todos os ZIPs são parseados num
+    único pool de threads.
+    """
+    stream = _STREAMS[kind]
+
+    def one(job) -> dict[str, list]:
+        name, opener = job
+        with opener() as fp: return stream(fp, name)
+
+    cols={}
+    with ExitStack() as zips:
+        jobs = []
+        for name, raw in uploads:
+            if name.lower().endswith(".xml"):
+                jobs.append((name, partial(io.BytesIO, raw)))
+            else:
+                zf = zips.enter_context(zipfile.ZipFile(io.BytesIO(raw)))
+                jobs += [(i.filename, partial(zf.open, i)) for i in zf.infolist()
+                         if i.filename.lower().endswith(".xml")]
+        with ThreadPoolExecutor() as ex:
+            for blk in ex.map(one, jobs): cols_extend(cols, blk)
+    return cols
+
+def _df_key(df: pd.DataFrame) -> tuple:
+    """
+    Chave exata p/ o cache: colunas + hash de todas as linhas. O hash padrão do
+    st.cache_data só amostra frames grandes e devolveria exportações antigas.
+    """
+    return (tuple(df.columns),
+            pd.util.hash_pandas_object(df, index=False).values.tobytes())
+
+_DF_HASH = {pd.DataFrame: _df_key}
+
+@st.cache_data(show_spinner=False, max_entries=32, hash_funcs=_DF_HASH)
+def df_to_xlsx(df: pd.DataFrame) -> bytes:
+    """
+    Bytes do .xlsx (memoizado pelo conteúdo exato do DataFrame).
+    Escrito linha a linha em `constant_memory` (o xlsxwriter descarta cada linha
+    ao avançar); o `to_excel` do pandas grava por coluna e perderia dados nesse modo.
+    """
+    buf=io.BytesIO()
+    with xlsxwriter.Workbook(buf, {"constant_memory": True}) as wb:
+        ws = wb.add_worksheet()
+        ws.write_row(0, 0, list(df.columns), wb.add_format({"bold": True}))
+        for r, row in enumerate(df.itertuples(index=False, name=None), 1):
+            ws.write_row(r, 0, [None if v != v else v for v in row])   # NaN → vazio
+    buf.seek(0)
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=32, hash_funcs=_DF_HASH)
+def df_to_parquet(df: pd.DataFrame) -> bytes:
+    """Bytes do .parquet (colunar, zstd) — bem menor e mais rápido que o .xlsx."""
+    buf=io.BytesIO(); df.to_parquet(buf, engine="pyarrow", compression="zstd", index=False)
+    return buf.getvalue()
+
 # =============================================================
 #  Loader: aceita XML direto ou ZIP de XMLs
 # =============================================================
 def load_files(label:str, key:str):
-    """Devolve lista de (nome, bytes)."""
+    """Devolve lista de (nome, bytes) dos uploads (ZIPs ainda compactados)."""
     up = st.file_uploader(label, accept_multiple_files=True,
                           type=["xml","zip"], key=f"upl_{key}")
-    files=[]
-    if up:
-        for f in up:
-            if f.name.lower().endswith(".xml"):
-                files.append((f.name,f.read()))
-            else:
-                with tempfile.TemporaryDirectory() as td:
-                    zpath=os.path.join(td,"tmp.zip")
-                    open(zpath,"wb").write(f.read())
-                    with zipfile.ZipFile(zpath) as zf:
-                        for n in zf.namelist():
-                            if n.lower().endswith(".xml"):
-                                files.append((n, zf.read(n)))
-    return files
+    return [(f.name, f.getvalue()) for f in up] if up else []
 
 # =============================================================
 #  Aba layout
@@ -152,15 +289,12 @@ with tab_home:
 # ---------------- CT-e ---------------------------------------
 with tab_cte:
     st.header("Upload CT-e")
-    rows_cte=[]
-    for n,raw in load_files("Selecione CT-e (XML ou ZIP):","cte"):
-        rows_cte.extend(parse_cte(raw,n))
-    if rows_cte:
-        df_cte=pd.DataFrame(rows_cte)
-        st.dataframe(df_cte, use_container_width=True)
+    cols_cte=parse_uploads(load_files("Selecione CT-e (XML ou ZIP):","cte"), "cte")
+    if cols_cte:
+        df_cte=pd.DataFrame(cols_cte, copy=False)
+        st.dataframe(br_view(df_cte, BR_COLS_CTE), use_container_width=True)
         st.session_state["df_cte"]=df_cte
-        buf=io.BytesIO(); df_cte.to_excel(buf,index=False)
-        st.download_button("📥 Baixar CT-e.xlsx", buf.getvalue(),
+        st.download_button("📥 Baixar CT-e.xlsx", df_to_xlsx(df_cte),
                            "cte.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
     else:
         st.info("Nenhum CT-e carregado.")
@@ -168,16 +302,12 @@ with tab_cte:
 # ---------------- NF-e ---------------------------------------
 with tab_nfe:
     st.header("Upload NF-e")
-    rows_nfe=[]
-    for n,raw in load_files("Selecione NF-e (XML ou ZIP):","nfe"):
-        d=parse_nfe(raw,n)
-        if d: rows_nfe.append(d)
-    if rows_nfe:
-        df_nfe=pd.DataFrame(rows_nfe)
-        st.dataframe(df_nfe,use_container_width=True)
+    cols_nfe=parse_uploads(load_files("Selecione NF-e (XML ou ZIP):","nfe"), "nfe")
+    if cols_nfe:
+        df_nfe=pd.DataFrame(cols_nfe, copy=False)
+        st.dataframe(br_view(df_nfe, BR_COLS_NFE),use_container_width=True)
         st.session_state["df_nfe"]=df_nfe
-        buf=io.BytesIO(); df_nfe.to_excel(buf,index=False)
-        st.download_button("📥 Baixar NF-e.xlsx", buf.getvalue(),
+        st.download_button("📥 Baixar NF-e.xlsx", df_to_xlsx(df_nfe),
                            "nfe.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
     else:
         st.info("Nenhum NF-e carregado.")
@@ -194,9 +324,14 @@ with tab_merge:
         merged = pd.merge(df_cte, df_nfe, on="Chave NF", how="inner",
                           suffixes=("_CTE","_NFE"))
         st.success(f"Documentos correspondentes: **{len(merged)}** registro(s)")
-        st.dataframe(merged,use_container_width=True)
+        st.dataframe(br_view(merged, BR_COLS_CTE + BR_COLS_NFE),
+                     use_container_width=True)
 
-        buf = io.BytesIO(); merged.to_excel(buf,index=False)
-        st.download_button("📥 Baixar Unificado.xlsx", buf.getvalue(),
-                           "cte_nfe_unificado.xlsx",
-                           mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        st.download_button("📥 Baixar Unificado.parquet", df_to_parquet(merged),
+                           "cte_nfe_unificado.parquet", mime="application/octet-stream")
+        # o .xlsx é o passo mais lento: só é gerado sob demanda
+        # (o corpo de um st.expander roda mesmo fechado, por isso o toggle)
+        if st.toggle("Gerar também .xlsx", key="xlsx_merge"):
+            st.download_button("📥 Baixar Unificado.xlsx", df_to_xlsx(merged),
+                               "cte_nfe_unificado.xlsx",
+                               mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
@@ -0,0 +1,45 @@
+import io, os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402  (o Streamlit roda em "bare mode" no import)
+
+
+def _cte(*infq: tuple[str, str, str], frete: str = "1000.00") -> bytes:
+    qs = "".join(f"<infQ><cUnid>{u}</cUnid><tpMed>{t}</tpMed><qCarga>{q}</qCarga></infQ>"
+                 for u, t, q in infq)
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<cteProc xmlns="http://www.portalfiscal.inf.br/cte"><CTe><infCte Id="CTe1">
+ <ide><nCT>1</nCT><dhEmi>2024-03-15T10:20:30-03:00</dhEmi></ide>
+ <vPrest><vTPrest>{frete}</vTPrest></vPrest>
+ <infCTeNorm><infCarga>{qs}</infCarga></infCTeNorm>
+</infCte></CTe></cteProc>""".encode()
+
+
+def _parse(raw: bytes) -> dict[str, list]:
+    return app.parse_cte_stream(io.BytesIO(raw), "t.xml")
+
+
+def test_peso_usa_so_peso_bruto_em_kg():
+    cols = _parse(_cte(("01", "PESO BRUTO", "1000.0000"),
+                       ("01", "PESO BASE DE CALCULO", "1000.0000"),
+                       ("03", "VOLUMES", "10.0000")))
+    assert cols["Peso (kg)"] == [1000.0]
+    assert cols["R$/ton"] == [1000.0]
+
+
+def test_peso_converte_toneladas():
+    cols = _parse(_cte(("02", "PESO BRUTO", "2.5")))
+    assert cols["Peso (kg)"] == [2500.0]
+
+
+def test_peso_sem_bruto_usa_primeiro_tpmed():
+    cols = _parse(_cte(("03", "VOLUMES", "4"),
+                       ("01", "PESO AFERIDO", "300"),
+                       ("01", "PESO CUBADO", "450")))
+    assert cols["Peso (kg)"] == [300.0]
+
+
+def test_peso_sem_medida_de_peso():
+    cols = _parse(_cte(("03", "VOLUMES", "4")))
+    assert cols["Peso (kg)"] == [0.0]
+    assert cols["R$/ton"] == [None]